@@ -54,21 +54,44 @@
 #        <timestamp>;<number>;<name>;<block/allow>
 #
 # All matches are case-insensitive
+# A pattern must match the whole Caller ID number or name field
 # Matches are applied to the Caller ID number and name fields separately
 #
 # Picking up a phone and pressing the "*" key within 10 seconds will add the
 # current calling number to the block list
 # 
-# SIGHUP will force reloading of the allow/block lists before the next call
+# SIGHUP will reload the allow/block lists in the background, and they are
+# swapped in (and the call log reopened) before the next call
 #
 
 import sys
 import os
 import time
 import signal
+import threading
+import selectors
+import atexit
+import shutil
+import tempfile
 import serial
 import re
 import functools
+import collections
+try:
+    # Hyperscan matches all patterns of a list in one pass
+    import hyperscan
+except ImportError:
+    hyperscan = None
+try:
+    # RE2 matches in linear time, safe for any pattern added to the lists
+    import re2 as listre
+except ImportError:
+    listre = re
+try:
+    # regex is a faster, more complete re for patterns RE2 can't handle
+    import regex as userre
+except ImportError:
+    userre = re
 print = functools.partial(print, flush=True)
 
 # configuration
@@ -81,12 +104,38 @@ blocklist_lifetime_days = 9*30
 
 day_secs = 24*60*60
 
+timestamp_format = "%Y-%m-%d %H:%M"
+
+# Caller ID field header ("NMBR = ") in modem lines
+header_re = re.compile(rb'^\w+\s*=\s*')
+
+# Caller ID fields, keyed on modem line tag
+caller_id_fields = {b"DATE": 'date', b"TIME": 'time', b"NMBR": 'number', b"NAME": 'name'}
+
+# list entries that can't share a combined pattern with other entries
+uncombinable_re = re.compile(r'\\[1-9]|\\g<|\(\?P[<=>]|\(\?\(|\(\?[aiLmsux]+\)')
+
+# list entries RE2 and Hyperscan would read differently from re, taking
+# "x{,n}" literally
+re_only_re = re.compile(r'\{,')
+
+# compiled list patterns, keyed on regex
+pattern_cache = {}
+
+# allow/block lists reloaded after SIGHUP, swapped in when reload_config is set
+reload_lock = threading.Lock()
+pending_lists = None
 reload_config = False
 
 def main():
     global blocklist
     global allowlist
     global reload_config
+    global calllog
+
+    # open call log (line buffered so each call is written out)
+    calllog = open(calllog_file, 'a', buffering=1)
+    atexit.register(lambda: calllog.close())
 
     # open modem
     modem = Modem(modem_port, 1200)
@@ -100,6 +149,7 @@ def main():
     # read allowlist
     print("Reading allow list file...")
     allowlist = read_list(allowlist_file)
+    allowlist.matchers, allowlist.literals = build_matchers(allowlist)
     print("Allow List:")
     print_list(allowlist)
     update_list_match(allowlist, allowlist_file)
@@ -107,6 +157,7 @@ def main():
     # read blocklist
     print("Reading block list file...")
     blocklist = read_list(blocklist_file)
+    blocklist.matchers, blocklist.literals = build_matchers(blocklist)
     print("Block list:")
     print_list(blocklist)
     update_list_match(blocklist, blocklist_file)
@@ -116,10 +167,7 @@ def main():
 
     blocklist_purge_time = 0.0
     last_ring = 0.0
-    call_date = ""
-    call_time = ""
-    call_name = ""
-    call_number = ""
+    call_id = {}
 
     print("Waiting for call...")
     
@@ -128,64 +176,70 @@ def main():
         if time.time()-blocklist_purge_time > blocklist_purge_days * day_secs:
             blocklist_purge_time = time.time()
             purge_list(blocklist, blocklist_file, blocklist_lifetime_days)
+            # rebuild matchers now if any entry was purged, not during a call
+            if blocklist.matchers is None:
+                blocklist.matchers, blocklist.literals = build_matchers(blocklist)
 
         # wait for RING or rest of Caller ID
         line = modem.read_line()
 
-        # check for SIGHUP to reload allow/block lists
+        # check for allow/block lists reloaded after SIGHUP
         if reload_config:
             reload_config = False
-            
-            # read allowlist
-            print("Reading allow list file...")
-            allowlist = read_list(allowlist_file)
-            print("Allow List:")
-            print_list(allowlist)
-            update_list_match(allowlist, allowlist_file)
 
-            # read blocklist
-            print("Reading block list file...")
-            blocklist = read_list(blocklist_file)
-            print("Block list:")
-            print_list(blocklist)
-            update_list_match(blocklist, blocklist_file)
+            # reopen call log in case it was rotated
+            calllog.close()
+            calllog = open(calllog_file, 'a', buffering=1)
+
+            # swap in reloaded lists, keeping matches made while they were read
+            new_allowlist, new_blocklist = pending_lists
+            if new_allowlist is not allowlist:
+                merge_list_matches(allowlist, new_allowlist)
+                allowlist = new_allowlist
+                update_list_match(allowlist, allowlist_file)
+            if new_blocklist is not blocklist:
+                merge_list_matches(blocklist, new_blocklist)
+                blocklist = new_blocklist
+                update_list_match(blocklist, blocklist_file)
+            prune_pattern_cache(allowlist, blocklist)
+
+            # a list file written since it was read (purge, * key) must be
+            # read again
+            if (file_signature(allowlist_file) != allowlist.signature or
+                file_signature(blocklist_file) != blocklist.signature):
+                start_reload()
 
         # look for RING and Caller ID
-        if line.startswith("RING"):
+        tag = line[:4]
+        if tag == b"RING":
             if time.monotonic()-last_ring > 7.0:
                 print("New call...")
             last_ring = time.monotonic()
-            if not call_date:
+            if not call_id.get('date'):
                 continue
-        elif line.startswith("DATE"):
-            call_date = re.sub('^\w+\s*=\s*', '', line)
-            continue
-        elif line.startswith("TIME"):
-            call_time = re.sub('^\w+\s*=\s*', '', line)
-            continue
-        elif line.startswith("NMBR"):
-            call_number = re.sub('^\w+\s*=\s*', '', line)
-            continue
-        elif line.startswith("NAME"):
-            call_name = re.sub('^\w+\s*=\s*', '', line)
-            if not call_date:
+        elif tag in caller_id_fields:
+            call_id[caller_id_fields[tag]] = header_re.sub(b'', line)
+            if tag != b"NAME" or not call_id.get('date'):
                 continue
         else:
             continue
 
         # caller ID is complete when NAME seen or RING after DATE
+        call_date, call_time, call_number, call_name = (
+            call_id.get(field, b"").decode(errors='replace') for field in ('date', 'time', 'number', 'name'))
         print("Caller ID date=" + call_date + " time=" + call_time + " number=" + call_number + " name=" + call_name)
 
         # create timestamp
         timestamp = time.strftime('%Y') + "-" + call_date[0:2] + "-" + call_date[2:4] + " " + call_time[0:2] + ":" + call_time[2:4]
-            
+        timestamp_epoch = parse_timestamp(timestamp)
+
         # check for matches
         match = "no match"
-        if match_list_both(allowlist, "allow", call_number, call_name, timestamp):
+        if match_list_both(allowlist, "allow", call_number, call_name, timestamp, timestamp_epoch):
             match = "allow"
             # update allowlist match
             update_list_match(allowlist, allowlist_file)
-        elif match_list_both(blocklist, "block", call_number, call_name, timestamp):
+        elif match_list_both(blocklist, "block", call_number, call_name, timestamp, timestamp_epoch):
             match = "block"
             # update blocklist match
             update_list_match(blocklist, blocklist_file)
@@ -197,19 +251,16 @@ def main():
             print("No list match")
             if (modem.wait_for_star()):
                 print("User * key seen...")
-                item = {}
                 regex = call_number
                 try:
-                    item['regex'] = re.compile(regex, re.IGNORECASE)
-                except re.error:
+                    pattern = compile_pattern(regex)
+                except userre.error:
                     print("Invalid regular expression '" + regex + "'")
                     regex = ""
                 if regex:
-                    item['timestamp'] = time.strftime("%Y-%m-%d %H:%M")
-                    item['count'] = 0
-                    item['permanent'] = False
-                    item['note'] = "added by user * key"
-                    blocklist[regex] = item
+                    now, now_epoch = timestamp_now()
+                    blocklist.add(regex, pattern, False, "added by user * key", now, now_epoch)
+                    blocklist.matchers, blocklist.literals = build_matchers(blocklist)
                     with open(blocklist_file, 'a') as file:
                         line = regex + ";;added by user * key\n"
                         file.write(line)
@@ -217,14 +268,10 @@ def main():
                     match = "added to block by user * key"
 
         # log call
-        with open(calllog_file, 'a') as file:
-            line = timestamp + "  " + space_fill(call_number, 12) + space_fill(call_name, 17) + " : " + match + "\n"
-            file.write(line)
+        line = timestamp + "  " + (call_number + " ").ljust(12) + (call_name + " ").ljust(17) + " : " + match + "\n"
+        calllog.write(line)
 
-        call_date = ""
-        call_time = ""
-        call_name = ""
-        call_number = ""
+        call_id = {}
         print("Waiting for call...")
 
     # close modem
@@ -233,22 +280,33 @@ def main():
     modem.close()
 
 
-def space_fill(s, count):
-    return s + " " + (" " * (count-len(s)-1))
-    
+def timestamp_now():
+    # list entry timestamp for now, as string and epoch seconds
+    now = time.time()
+    return time.strftime(timestamp_format, time.localtime(now)), int(now)
+
+def parse_timestamp(timestamp):
+    # list entry timestamp string to epoch seconds (now if invalid)
+    try:
+        return int(time.mktime(time.strptime(timestamp, timestamp_format)))
+    except ValueError:
+        print("Invalid timestamp '" + timestamp + "'")
+        return int(time.time())
+
 def read_list(list_file):
-    # list is an dictionary of dictionaries, keyed on regex
-    list = {}
+    # list is a MatchList of the entries, indexed in file order
+    list = MatchList()
+    list.signature = file_signature(list_file)
 
     # process list
     if not os.path.exists(list_file):
         print("List file " + list_file + " not found")
         return list
 
-    now = time.strftime("%Y-%m-%d %H:%M")
+    now, now_epoch = timestamp_now()
     with open(list_file) as file:
         for line in file:
-            line = re.sub('\n|\r', '', line)
+            line = line.rstrip('\r\n')
             if line.startswith("#"):
                 continue
             line_list = line.split(";")
@@ -256,24 +314,19 @@ def read_list(list_file):
             regex = line_list.pop(0)
             if not regex:
                 continue
-            item = {}
             # regex may have a "\;" embedded in it
             while regex and regex.endswith("\\") and line_list:
                 regex = regex[:-1]
                 regex += ";" + line_list.pop(0)
             try:
-                item['regex'] = re.compile(regex, re.IGNORECASE)
-            except re.error:
+                pattern = compile_pattern(regex)
+            except userre.error:
                 print("Invalid regular expression '" + regex + "', skipping entry")
                 regex = ""
             if regex:
-                item['regex'] = re.compile(regex, re.IGNORECASE)
                 flags = line_list.pop(0) if line_list else ""
-                item['permanent'] = 'p' in flags or 'P' in flags
-                item['note'] = ";".join(line_list)
-                item['timestamp'] = now
-                item['count'] = 0
-                list[regex] = item
+                permanent = 'p' in flags or 'P' in flags
+                list.add(regex, pattern, permanent, ";".join(line_list), now, now_epoch)
 
     # process match history file for list
     match_file = list_file + "-match"
@@ -283,7 +336,7 @@ def read_list(list_file):
 
     with open(match_file) as file:
         for line in file:
-            line = re.sub('\n|\r', '', line)
+            line = line.rstrip('\r\n')
             line_list = line.split(";", 3)
             # timestamp;count;regex
             if len(line_list) == 3:
@@ -291,39 +344,148 @@ def read_list(list_file):
                 count = line_list.pop(0)
                 regex = line_list.pop(0)
                 if regex in list:
-                    list[regex]['timestamp'] = timestamp
-                    list[regex]['count'] = int(count)
+                    i = list.index_of[regex]
+                    list.timestamps[i] = timestamp
+                    list.timestamp_epochs[i] = parse_timestamp(timestamp)
+                    list.counts[i] = int(count)
             else:
                 print("Invalid line in match file: '" + line + "'")
                     
     return list
 
+def compile_pattern(regex):
+    # list entry patterns are cached so reloading the lists only compiles
+    # new patterns
+    pattern = pattern_cache.get(regex)
+    if pattern is None:
+        pattern = pattern_cache[regex] = new_pattern(regex)
+    return pattern
+
+def new_pattern(regex):
+    # compile with RE2 if installed, else (or if RE2 can't handle it or would
+    # read it differently) with regex or re
+    if listre is not re and re_only_re.search(regex):
+        print("Pattern '" + regex + "' read differently by RE2, using " + userre.__name__)
+    elif listre is not re:
+        try:
+            return listre.compile("(?i)" + regex)
+        except listre.error:
+            print("Pattern '" + regex + "' not supported by RE2, using " + userre.__name__)
+    return userre.compile(regex, userre.IGNORECASE)
+
+def prune_pattern_cache(*lists):
+    # drop cached patterns no longer in any of the lists
+    # (the cache may be added to by a reload meanwhile)
+    for regex in [regex for regex in tuple(pattern_cache) if not any(regex in list for list in lists)]:
+        pattern_cache.pop(regex, None)
+
+def file_signature(list_file):
+    # (mtime, size) of list file, to tell if it changed since it was read
+    try:
+        st = os.stat(list_file)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 def update_list_match(list, list_file):
     match_file = list_file + "-match"
     with open(match_file, 'w') as file:
-        for regex, item in list.items():
-            line = item['timestamp'] + ";" + str(item['count']) + ";" + regex + "\n"
+        for regex, timestamp, count in zip(list.regexes, list.timestamps, list.counts):
+            line = timestamp + ";" + str(count) + ";" + regex + "\n"
             file.write(line)
 
-def match_list_both(list, list_type, number, name, timestamp):
+def merge_list_matches(old_list, new_list):
+    # take last match and count of entries still in the list from the old
+    # list, which is up to date with any calls matched since new_list was read
+    for i, regex in enumerate(new_list.regexes):
+        j = old_list.index_of.get(regex)
+        if j is not None:
+            new_list.timestamps[i] = old_list.timestamps[j]
+            new_list.timestamp_epochs[i] = old_list.timestamp_epochs[j]
+            new_list.counts[i] = old_list.counts[j]
+
+def match_list_both(list, list_type, number, name, timestamp, timestamp_epoch):
     print("Checking " + list_type + " list...")
-    if match_list(list, number, timestamp) or match_list(list, name, timestamp):
+    if (match_list(list, number, timestamp, timestamp_epoch) or
+        match_list(list, name, timestamp, timestamp_epoch)):
         print("Matched " + list_type + " list")
         return True
     return False
 
-def match_list(list, string, timestamp):
-    for regex, item in list.items():
-        if item['regex'].match(string):
-            item['timestamp'] = timestamp
-            item['count'] += 1
-            print("Matched pattern '" + regex + "' count " + str(item['count']))
-            return True
-    return False
+def match_list(list, string, timestamp, timestamp_epoch):
+    if list.matchers is None:
+        list.matchers, list.literals = build_matchers(list)
+    # literal entries (most numbers) are found without running any pattern,
+    # the other entries by the matchers
+    i = list.literals.get(string.lower())
+    if i is None:
+        i = match_patterns(list.matchers, string)
+        if i is None:
+            return False
+    list.timestamps[i] = timestamp
+    list.timestamp_epochs[i] = timestamp_epoch
+    list.counts[i] += 1
+    print("Matched pattern '" + list.regexes[i] + "' count " + str(list.counts[i]))
+    return True
+
+def match_patterns(matchers, string):
+    # index of first entry matching string, or None
+    for pattern, i, groups in matchers:
+        m = pattern.fullmatch(string)
+        if m:
+            return groups[m.lastgroup] if groups else i
+    return None
+
+def build_matchers(list):
+    # literal entries (no special characters) only match a string equal to
+    # them: literals maps them, lower case, to their index
+    # other entries are combined in runs of consecutive entries into one
+    # pattern so a single fullmatch() checks them all, in list order; entries
+    # using their own named groups, group references or inline flags are
+    # matched by themselves, as are entries RE2 couldn't compile when the rest
+    # are compiled with RE2, and entries Hyperscan would read differently
+    # matchers are (pattern, index, groups) with groups mapping group -> index
+    matchers = []
+    literals = {}
+    run = []
+    for i, (regex, pattern) in enumerate(zip(list.regexes, list.patterns)):
+        if re.escape(regex) == regex:
+            literals.setdefault(regex.lower(), i)
+        elif (uncombinable_re.search(regex) or (hyperscan and re_only_re.search(regex)) or
+              (listre is not re and isinstance(pattern, userre.Pattern))):
+            matchers += combine_patterns(list, run)
+            run = []
+            matchers.append((pattern, i, None))
+        else:
+            run.append(i)
+    matchers += combine_patterns(list, run)
+    return matchers, literals
+
+def combine_patterns(list, run):
+    # a Hyperscan database for the run if installed, else an alternation of
+    # named groups; a run Hyperscan rejects is split until the rejected
+    # entries are found
+    if not run:
+        return []
+    groups = {"e" + str(n): i for n, i in enumerate(run)}
+    if hyperscan:
+        try:
+            return [(HyperscanPattern([list.regexes[i] for i in run]), None, groups)]
+        except hyperscan.error:
+            if len(run) > 1:
+                half = len(run) // 2
+                return combine_patterns(list, run[:half]) + combine_patterns(list, run[half:])
+            print("Pattern '" + list.regexes[run[0]] + "' not supported by Hyperscan")
+    try:
+        parts = ["(?P<" + group + ">" + list.regexes[i] + ")" for group, i in groups.items()]
+        return [(new_pattern("|".join(parts)), None, groups)]
+    except userre.error:
+        return [(list.patterns[i], i, None) for i in run]
 
 def print_list(list):
-    for key, item in list.items():
-        print(key + " : " + str(item))
+    for i, regex in enumerate(list.regexes):
+        print(regex + " : timestamp " + list.timestamps[i] + " count " + str(list.counts[i]) +
+              (" permanent" if list.permanent[i] else "") + " note '" + list.notes[i] + "'")
 
 def purge_list(list, list_file, lifetime_days):
     if not os.path.exists(list_file):
@@ -331,12 +493,14 @@ def purge_list(list, list_file, lifetime_days):
 
     print("Purging entries from " + list_file + " not matched in " + str(lifetime_days) + " days...")
     now = time.time()
-    new_contents = ""
     file_changed = False
-    with open(list_file) as file:
+    # lines are written as they are read to a new file beside the list,
+    # which replaces the list if any entry was purged
+    new_file = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(list_file) or ".", delete=False)
+    with open(list_file) as file, new_file:
         for line in file:
             if not line.startswith("#"):
-                line_list = re.sub('\n|\r', '', line).split(";")
+                line_list = line.rstrip('\r\n').split(";")
                 # regex[;flags[;note]]
                 regex = line_list.pop(0)
                 # regex may have a "\;" embedded in it
@@ -344,32 +508,115 @@ def purge_list(list, list_file, lifetime_days):
                     regex = regex[:-1]
                     regex += ";" + line_list.pop(0)
                 if regex in list:
-                    item = list[regex]
-                    print("Block item '" + regex + "' last blocked on " +
-                          item['timestamp'] + " count " + str(item['count']))
-                    last_time = time.mktime(time.strptime(item['timestamp'], "%Y-%m-%d %H:%M"))
-                    if not item['permanent'] and now-last_time > lifetime_days * day_secs:
+                    i = list.index_of[regex]
+                    timestamp = list.timestamps[i]
+                    count = str(list.counts[i])
+                    print("Block item '" + regex + "' last blocked on " + timestamp + " count " + count)
+                    last_time = list.timestamp_epochs[i]
+                    if not list.permanent[i] and now-last_time > lifetime_days * day_secs:
                         print("Removed '" + regex + "' from block list.")
-                        print("    last blocked on " + item['timestamp'] + " count " + str(item['count']))
-                        line = "# last blocked on " + item['timestamp'] + " count " + str(item['count']) + " #" + line
+                        print("    last blocked on " + timestamp + " count " + count)
+                        line = "# last blocked on " + timestamp + " count " + count + " #" + line
                         # remove from running list too
-                        del list[regex]
+                        list.remove(regex)
                         file_changed = True
-            new_contents += line
+            new_file.write(line)
 
     if file_changed:
-        # save existing file as backup
+        # save existing file as backup (copied, so a reload never finds the
+        # list file missing)
         backup_file = list_file + "-backup"
-        if os.path.exists(backup_file):
-            os.remove(backup_file)
-        os.rename(list_file, backup_file)
-        
-        # write changed file
-        with open(list_file, 'w') as file:
-            file.write(new_contents)
+        shutil.copy2(list_file, backup_file)
+
+        # move changed file into place
+        shutil.copymode(list_file, new_file.name)
+        os.replace(new_file.name, list_file)
+    else:
+        os.remove(new_file.name)
     return
 
 
+class MatchList:
+    # allow/block list entries as parallel lists, one per field, indexed in
+    # list order; the match loop only needs regexes and patterns, and the
+    # entries need no per-entry dictionary
+    # the compiled matchers must be rebuilt after any entry is added or
+    # removed (else they are rebuilt on the next match)
+    def __init__(self):
+        self.regexes = []               # pattern as in list file
+        self.patterns = []              # compiled pattern
+        self.permanent = []             # never purged
+        self.notes = []
+        self.timestamps = []            # last match
+        self.timestamp_epochs = []
+        self.counts = []                # number of matches
+        self.index_of = {}              # regex -> index
+        self.matchers = None
+        self.literals = None
+        self.signature = None
+
+    def __contains__(self, regex):
+        return regex in self.index_of
+
+    def __len__(self):
+        return len(self.regexes)
+
+    def add(self, regex, pattern, permanent, note, timestamp, timestamp_epoch, count=0):
+        # an entry repeated in the list replaces the earlier one in its place
+        i = self.index_of.get(regex)
+        if i is None:
+            self.index_of[regex] = len(self.regexes)
+            self.regexes.append(regex)
+            self.patterns.append(pattern)
+            self.permanent.append(permanent)
+            self.notes.append(note)
+            self.timestamps.append(timestamp)
+            self.timestamp_epochs.append(timestamp_epoch)
+            self.counts.append(count)
+        else:
+            self.patterns[i] = pattern
+            self.permanent[i] = permanent
+            self.notes[i] = note
+            self.timestamps[i] = timestamp
+            self.timestamp_epochs[i] = timestamp_epoch
+            self.counts[i] = count
+        self.matchers = None
+
+    def remove(self, regex):
+        i = self.index_of[regex]
+        for field in (self.regexes, self.patterns, self.permanent, self.notes,
+                      self.timestamps, self.timestamp_epochs, self.counts):
+            del field[i]
+        self.index_of = {regex: i for i, regex in enumerate(self.regexes)}
+        self.matchers = None
+
+
+HyperscanMatch = collections.namedtuple('HyperscanMatch', 'lastgroup')
+
+class HyperscanPattern:
+    # list patterns compiled into one Hyperscan database, used like a
+    # combined pattern: fullmatch() names the first pattern in list order
+    # matching the whole string as lastgroup "e<index>"
+    def __init__(self, patterns):
+        flags = (hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH |
+                 hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP)
+        self.db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        self.db.compile(expressions=[("^(?:" + pattern + ")\\z").encode() for pattern in patterns],
+                        ids=list(range(len(patterns))), flags=[flags] * len(patterns))
+        self.scratch = hyperscan.Scratch(self.db)
+
+    def fullmatch(self, string):
+        ids = []
+        self.db.scan(string.encode(), match_event_handler=self.on_match, context=ids, scratch=self.scratch)
+        if ids:
+            return HyperscanMatch("e" + str(min(ids)))
+        return None
+
+    @staticmethod
+    def on_match(id, start, end, flags, ids):
+        ids.append(id)
+
+
 class Modem(serial.Serial):
     def __init__(self, port, baud):
         serial.Serial.__init__(self, port=port, baudrate=baud)
@@ -382,15 +629,16 @@ class Modem(serial.Serial):
         if not wait:
             return True
         line = self.read_line()
-        if line == command:
+        if line == command.encode():
             line = self.read_line()
-        return line == "OK"
+        return line == b"OK"
     
     def read_line(self):
-        line = ""
+        # lines are returned as bytes, decoding is left to the caller
+        line = b""
         while not line:
-            line = re.sub('\n|\r', '', self.readline(200).decode())
-        print("Received '" + line + "'")
+            line = self.readline(200).rstrip(b'\r\n')
+        print("Received " + str(line))
         return line
 
     def wait_for_star(self):
@@ -399,26 +647,37 @@ class Modem(serial.Serial):
         self.send_command("AT+FCLASS=8")        # voice mode
         self.send_command("AT+VIP")             # reset voice parameters
         self.send_command("AT+VLS=4")           # mode 4 - stay on-hook
-        self.timeout = 1.0
         star_bytes = b'\x10/\x10*\x10~'         # <DLE>/<DLE>*<DLE>~ - DTMF *
         ring_bytes1 = b'\x10R'                  # <DLE>R - ring voltage
         ring_bytes2 = b'\x10r'                  # <DLE>r - ring tone
-        read_bytes = b''
+        read_bytes = bytearray()
+        selector = selectors.DefaultSelector()
+        selector.register(self.fileno(), selectors.EVENT_READ)
         last_ring = time.monotonic()
         while time.monotonic()-last_ring < 10.0 and not star_bytes in read_bytes:
-            read_bytes += self.read(1)
+            # sleep until bytes arrive or time is up, then read all that have
+            # arrived, keeping only the bytes that could still start a DTMF *
+            if not selector.select(10.0 - (time.monotonic()-last_ring)):
+                continue
+            del read_bytes[:1-len(star_bytes)]
+            # (read at least 1 byte so a readable fd with nothing waiting
+            # blocks or raises instead of spinning)
+            read_bytes.extend(self.read(self.in_waiting or 1))
+            if star_bytes in read_bytes:
+                # don't lose a * read along with a following \r\n
+                break
             if b'\n' in read_bytes:
                 # must re-init voice mode afer ring and \r\n
                 self.send_command("AT+VIP")
                 self.send_command("AT+VLS=4")
-                read_bytes = b''
+                del read_bytes[:read_bytes.rfind(b'\n')+1]
             if ring_bytes1 in read_bytes or ring_bytes2 in read_bytes:
                 print("Ring...")
                 read_bytes = read_bytes.replace(ring_bytes1, b'')
                 read_bytes = read_bytes.replace(ring_bytes2, b'')
                 last_ring = time.monotonic()
-        print("Read " + str(len(read_bytes)) + " bytes " + str(read_bytes))
-        self.timeout = None
+        selector.close()
+        print("Read " + str(len(read_bytes)) + " bytes " + str(bytes(read_bytes)))
         self.send_command("ATH")                # hang up modem (should not be off hook)
         return star_bytes in read_bytes
 
@@ -431,8 +690,32 @@ class Modem(serial.Serial):
         self.send_command("ATH")                # hang up modem
 
 def sighup_handler(signum, frame):
+    print("SIGHUP received - reloading allow/block lists")
+    start_reload()
+
+def start_reload():
+    # lists are read in a thread so calls are still handled meanwhile
+    threading.Thread(target=reload_lists, daemon=True).start()
+
+def reload_lists():
+    # read the changed allow/block lists, compile their matchers and stage
+    # them for the main loop to swap in
+    global pending_lists
     global reload_config
-    print("SIGHUP received - reloading allow/block lists on next call")
-    reload_config = True
+    with reload_lock:
+        lists = []
+        for list, list_file, list_type in ((allowlist, allowlist_file, "allow"),
+                                           (blocklist, blocklist_file, "block")):
+            if file_signature(list_file) != list.signature:
+                print("Reading " + list_type + " list file...")
+                list = read_list(list_file)
+                list.matchers, list.literals = build_matchers(list)
+                print(list_type.capitalize() + " list:")
+                print_list(list)
+            else:
+                print(list_type.capitalize() + " list file unchanged")
+            lists.append(list)
+        pending_lists = lists
+        reload_config = True
 
 main()